@@ -1,7 +1,8 @@
 #!/usr/bin/env python
-from flask import Flask, redirect, abort, Response
+from flask import Flask, redirect, abort, Response, request, g
 import tempfile
-import os, urllib, _thread, boto3, re, sys, time, traceback, json
+import os, urllib, threading, boto3, re, sys, time, traceback, json
+import collections, concurrent.futures, functools, heapq, hmac, itertools, queue
 from datetime import datetime
 from dateutil.tz import tzutc
 from os.path import dirname, basename
@@ -114,6 +115,11 @@ class CacheEntry:
         self.consistency_checks = 0
         self.consecutive_unsuccessful_consistency_checks = 0
         # ^^ What a travesty of a variable name.  I love it.
+        # Whether the last consistency check couldn't reach the source server,
+        # and so passed only because we give awol servers the benefit of the doubt
+        self.probe_failed = False
+        self.last_scrub = 0
+        self.scrub_result = None
 
     def log(self, msg):
         global app
@@ -168,11 +174,13 @@ class CacheEntry:
 
         # If we already have the file, we can quickly double-check that the file we
         # have cached is still consistent by checking ETag/Last-Modified times
+        self.probe_failed = False
         try:
             etag, last_modified, content_type = self.probe_headers()
         except:
             # If we run into an error during probe_headers(), we serve our
             # cached file to continue serving while the source server is awol
+            self.probe_failed = True
             self.log("Error while checking consistency, serving cached file")
             traceback.print_exc()
             return True
@@ -263,12 +271,18 @@ class CacheEntry:
             'key': self.key,
             'md5': self.md5,
             'etag': self.etag,
+            'canonical': canonical_url(self.url),
             'modified': self.modified.timestamp(),
             'consistency' : {
                 'last_check': self.last_consistency_check,
                 'last_good_check': self.last_successful_consistency_check,
                 'num_checks': self.consistency_checks,
                 'bad_streak': self.consecutive_unsuccessful_consistency_checks,
+                'probe_failed': self.probe_failed,
+            },
+            'scrub': {
+                'last_scrub': self.last_scrub,
+                'result': self.scrub_result,
             },
         }
 
@@ -282,6 +296,10 @@ class AWSCache:
 
         # This is a mapping from URLs to CacheEntry's
         self.cache = {}
+        # And this is a mapping from canonical URLs to keys of `self.cache`, so
+        # that requests for a different mirror of a file we have cached (or the
+        # same file over http instead of https, etc...) hit that same entry.
+        self.aliases = {}
         self.rebuild()
 
         self.start_time = time.time()
@@ -291,6 +309,7 @@ class AWSCache:
     def rebuild(self):
         # This is the new dictionary we'll use to build up our cache
         new_cache = {}
+        new_aliases = {}
 
         # Let's keep track of how long it takes to do this
         start_time = time.time()
@@ -304,6 +323,7 @@ class AWSCache:
             try:
                 new_cache_entry = CacheEntry(self.s3.Object(self.bucket_name, obj.key))
                 new_cache[new_cache_entry.url] = new_cache_entry
+                new_aliases[canonical_url(new_cache_entry.url)] = new_cache_entry.url
                 log("[%s] cache reloading object %s successful"%(new_cache_entry.url, obj.key))
             except:
                 log("[%s] cache reload failed"%(obj.key), level=logging.WARN)
@@ -314,6 +334,7 @@ class AWSCache:
         # and not disrupting our uptime one iota
         log("Cache rebuild finished in %.1fs"%(time.time() - start_time))
         self.cache = new_cache
+        self.aliases = new_aliases
 
     """
     check_cache_consistency()
@@ -378,16 +399,32 @@ class AWSCache:
         obj.upload_file(local_filename, ExtraArgs = extra_args)
         # Create the CacheEntry and add it into our in-memory cache listing
         self.cache[url] = CacheEntry(obj)
+        self.aliases[canonical_url(url)] = url
 
     def delete(self, url):
         if not url in self.cache:
             return
         self.cache[url].delete()
         del self.cache[url]
+        canonical = canonical_url(url)
+        if self.aliases.get(canonical, None) == url:
+            del self.aliases[canonical]
+
+    """
+    lookup(url)
+
+    Returns the CacheEntry for the given url, or for any url equivalent to it
+    under `canonical_url()`, or `None` if we have no such file cached.
+    """
+    def lookup(self, url):
+        entry = self.cache.get(url, None)
+        if entry is None:
+            entry = self.cache.get(self.aliases.get(canonical_url(url), None), None)
+        return entry
 
     def hit(self, url):
         self.total_hits += 1
-        return self.cache.get(url, None)
+        return self.lookup(url)
 
     """
     json_obj(self)
@@ -403,6 +440,360 @@ class AWSCache:
             'cache_entries': objs,
         }
 
+class RateLimiter:
+    """
+    RateLimiter(rate)
+
+    A token bucket handing out `rate` units per second, with at most a second's
+    worth saved up.  `acquire(amount)` takes `amount` units, going into debt if
+    need be, and sleeps until that debt would have been paid off.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.last)*self.rate)
+            self.last = now
+            self.tokens -= amount
+            wait = max(0, -self.tokens/self.rate)
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Scrubber:
+    """
+    Scrubber(aws_cache, checkpoint_path, ...)
+
+    The Scrubber slowly walks every entry in the cache in the background,
+    checking that each is still consistent with its source server and, if
+    `verify_bytes` is set, that the bytes stored in S3 still hash to the ETag
+    we report.  Anything stale or corrupt gets queued for redownloading, which
+    a single worker works through one file at a time.  Anything that is no
+    longer whitelisted (or is now black or greylisted) is reported, but never
+    redownloaded.
+
+    Each pass through the cache groups the entries by host, and up to
+    `max_hosts` workers each take one host at a time and work through its
+    files in order, picking up the next host as soon as they're done.  This
+    way a slow server only holds up its own files and the worker stuck on
+    it, while all of them (and the redownloads) share a budget of
+    `requests_per_second` upstream/S3 requests and `bytes_per_second` of
+    downloads.  If more than `max_refetches` files are waiting to be
+    redownloaded, any more we find are left for the next pass.  How far we
+    have got with each host is saved to `checkpoint_path` after every file,
+    so a restart picks up where we left off.  Once a full pass is done, we
+    wait `pass_interval` seconds before starting another.
+    """
+    def __init__(self, aws_cache, checkpoint_path, requests_per_second=2,
+                 bytes_per_second=10*1024*1024, verify_bytes=False,
+                 max_hosts=8, pass_interval=24*60*60, max_refetches=100,
+                 refetch_timeout=60*60):
+        self.aws_cache = aws_cache
+        self.checkpoint_path = checkpoint_path
+        self.request_limiter = RateLimiter(requests_per_second)
+        self.byte_limiter = RateLimiter(bytes_per_second)
+        self.verify_bytes = verify_bytes
+        self.max_hosts = max_hosts
+        self.pass_interval = pass_interval
+        self.refetch_queue = queue.Queue(max_refetches)
+        self.refetch_timeout = refetch_timeout
+
+        # This is the progress we persist in our checkpoint; `cursors` maps
+        # each host to the last of its URLs we scrubbed this pass, as we walk
+        # each host's files in sorted URL order.
+        self.cursors = {}
+        self.passes = 0
+        self.last_pass_finished = 0
+        self.checkpoint_lock = threading.Lock()
+        self.load_checkpoint()
+
+        # These statistics are transient, and start from zero on restart
+        self.num_scrubbed = 0
+        self.num_stale = 0
+        self.num_corrupt = 0
+        self.num_unverified = 0
+        self.num_unreachable = 0
+        self.num_delisted = 0
+        self.num_errors = 0
+        self.num_refetched = 0
+        self.recent_problems = collections.deque(maxlen=100)
+        self.stats_lock = threading.Lock()
+
+    def log(self, msg, level=logging.INFO):
+        log("[scrubber] %s"%(msg), level=level)
+
+    def load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path) as f:
+                state = json.load(f)
+            self.cursors = state['cursors']
+            self.passes = state['passes']
+            self.last_pass_finished = state['last_pass_finished']
+            self.log("Resuming pass %d on %d hosts"%(self.passes + 1, len(self.cursors)))
+        except (IOError, ValueError, KeyError):
+            self.log("No usable checkpoint, starting from the beginning")
+
+    def save_checkpoint(self):
+        # Write then rename, so that dying halfway through leaves us with the
+        # previous checkpoint rather than a truncated one
+        with self.checkpoint_lock:
+            tmp_path = self.checkpoint_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({
+                    'cursors': self.cursors,
+                    'passes': self.passes,
+                    'last_pass_finished': self.last_pass_finished,
+                }, f)
+            os.replace(tmp_path, self.checkpoint_path)
+
+    def start(self):
+        threading.Thread(target=self.run, name="scrubber", daemon=True).start()
+        threading.Thread(target=self.refetch, name="scrubber refetch", daemon=True).start()
+
+    def run(self):
+        # If we were restarted in between passes, finish out the wait rather
+        # than starting another pass straight away
+        if len(self.cursors) == 0 and self.passes > 0:
+            wait = self.pass_interval - (time.time() - self.last_pass_finished)
+            if wait > 0:
+                self.log("Waiting %.0fs before starting pass %d"%(wait, self.passes + 1))
+                time.sleep(wait)
+
+        while True:
+            try:
+                self.scrub_pass()
+            except:
+                self.log("Pass failed, backing off", level=logging.ERROR)
+                traceback.print_exc()
+                time.sleep(60)
+
+    def scrub_pass(self):
+        # Sort a snapshot of the keys, since downloads may be adding to the
+        # cache while we're looking through it
+        by_host = collections.defaultdict(list)
+        for url in sorted(self.aws_cache.cache):
+            by_host[urllib.parse.urlparse(url).netloc].append(url)
+
+        with concurrent.futures.ThreadPoolExecutor(self.max_hosts, "scrubber") as pool:
+            list(pool.map(self.scrub_host, by_host.keys(), by_host.values()))
+
+        self.passes += 1
+        self.last_pass_finished = time.time()
+        with self.checkpoint_lock:
+            self.cursors = {}
+        self.save_checkpoint()
+        self.log("Finished pass %d"%(self.passes))
+        time.sleep(self.pass_interval)
+
+    def scrub_host(self, host, urls):
+        for url in urls:
+            # Skip past whatever we already did this pass before a restart
+            if url <= self.cursors.get(host, ""):
+                continue
+
+            # It's possible that this entry has been deleted in the meantime
+            entry = self.aws_cache.cache.get(url, None)
+            if not entry is None:
+                try:
+                    self.scrub_entry(entry)
+                except:
+                    entry.scrub_result = "error"
+                    with self.stats_lock:
+                        self.num_errors += 1
+                    self.log("[%s] Scrub failed"%(url), level=logging.WARN)
+                    traceback.print_exc()
+
+            with self.checkpoint_lock:
+                self.cursors[host] = url
+            self.save_checkpoint()
+
+    def scrub_entry(self, entry):
+        if on_blacklist(entry.url) or on_greylist(entry.url) or not on_whitelist(entry.url):
+            # We'd never download these from a request, so we don't want to be
+            # redownloading them off our own bat either
+            result = "delisted"
+        else:
+            # Always make a fresh check, rather than trusting whatever the
+            # last request to come along found out.  (FTP URLs never get
+            # checked upstream, so they don't cost us anything.)
+            if not entry.url.startswith("ftp://"):
+                self.request_limiter.acquire()
+            if not entry.check_consistency(cache_time=0):
+                result = "stale"
+            elif entry.probe_failed:
+                result = "unreachable"
+            elif not self.verify_bytes:
+                result = "ok"
+            else:
+                verified = self.verify(entry)
+                if verified is None:
+                    result = "unverified"
+                elif verified:
+                    result = "ok"
+                else:
+                    result = "corrupt"
+
+        entry.last_scrub = time.time()
+        entry.scrub_result = result
+        with self.stats_lock:
+            self.num_scrubbed += 1
+            if result == "stale":
+                self.num_stale += 1
+            elif result == "corrupt":
+                self.num_corrupt += 1
+            elif result == "unverified":
+                self.num_unverified += 1
+            elif result == "unreachable":
+                self.num_unreachable += 1
+            elif result == "delisted":
+                self.num_delisted += 1
+            if result in ["stale", "corrupt", "unreachable", "delisted"]:
+                self.recent_problems.append({
+                    'url': entry.url,
+                    'result': result,
+                    'time': entry.last_scrub,
+                })
+
+        if result in ["stale", "corrupt"]:
+            self.log("[%s] Cached file is %s, queueing refetch"%(entry.url, result), level=logging.WARN)
+            try:
+                self.refetch_queue.put_nowait(entry)
+            except queue.Full:
+                self.log("[%s] Refetch queue full, leaving it for next pass"%(entry.url), level=logging.WARN)
+        elif result == "delisted":
+            self.log("[%s] Cached file is no longer whitelisted (or is black/greylisted)"%(entry.url), level=logging.WARN)
+
+    """
+    refetch()
+
+    Work through the refetch queue, one download at a time, charging each to
+    our request and byte budgets before it starts.
+    """
+    def refetch(self):
+        while True:
+            entry = self.refetch_queue.get()
+            self.request_limiter.acquire()
+            self.byte_limiter.acquire(entry.size)
+            done = fetch_in_background(entry.url)
+            if not done.wait(self.refetch_timeout):
+                self.log("[%s] Refetch still running after %ds, moving on"%(entry.url, self.refetch_timeout), level=logging.WARN)
+            with self.stats_lock:
+                self.num_refetched += 1
+
+    """
+    part_layout(entry)
+
+    Returns the `(part_size, num_parts)` the given entry was uploaded with, so
+    that we can recompute its ETag.  Objects uploaded in one go have a plain
+    MD5 ETag, and we return `(size, None)` for those.  Multipart uploads have
+    an ETag of the MD5 of each part's MD5 with "-<num_parts>" on the end, so
+    we ask S3 how big the first part was; every part but the last is the same
+    size.  Returns `None` if the layout S3 gives us doesn't add up.
+    """
+    def part_layout(self, entry):
+        if not "-" in entry.md5:
+            return entry.size, None
+        try:
+            num_parts = int(entry.md5.split("-")[-1])
+        except ValueError:
+            return None
+
+        self.request_limiter.acquire()
+        head = entry.s3_obj.meta.client.head_object(
+            Bucket=entry.s3_obj.bucket_name,
+            Key=entry.s3_obj.key,
+            PartNumber=1,
+            IfMatch='"%s"'%(entry.md5),
+        )
+        part_size = head['ContentLength']
+        if head.get('PartsCount', num_parts) != num_parts or part_size <= 0:
+            return None
+        if part_size*(num_parts - 1) >= entry.size or part_size*num_parts < entry.size:
+            return None
+        return part_size, num_parts
+
+    """
+    verify(entry)
+
+    Stream the stored object back down from S3 and check that it hashes to the
+    ETag we report for it, whether that's a plain MD5 or a multipart ETag.
+    Returns `None` if we couldn't check it: either we can't work out how it
+    was split up into parts, or it has been re-uploaded since we loaded this
+    entry.
+    """
+    def verify(self, entry, chunk_size=1024*1024):
+        from hashlib import md5
+        from botocore.exceptions import ClientError
+
+        # Asking only for the version we know about means that an object that
+        # has been re-uploaded since gets refused, rather than looking corrupt
+        try:
+            layout = self.part_layout(entry)
+            if layout is None:
+                return None
+            part_size, num_parts = layout
+
+            self.request_limiter.acquire()
+            body = entry.s3_obj.get(IfMatch='"%s"'%(entry.md5))['Body']
+        except ClientError as err:
+            if err.response.get('Error', {}).get('Code') in ["PreconditionFailed", "412"]:
+                return None
+            raise
+
+        # Hash each part separately, never reading across a part boundary
+        part_digests = []
+        part_hash = md5()
+        part_left = part_size
+        while True:
+            self.byte_limiter.acquire(chunk_size)
+            chunk = body.read(min(chunk_size, part_left))
+            if len(chunk) == 0:
+                break
+            part_hash.update(chunk)
+            part_left -= len(chunk)
+            if part_left == 0:
+                part_digests.append(part_hash.digest())
+                part_hash = md5()
+                part_left = part_size
+        if part_left != part_size:
+            part_digests.append(part_hash.digest())
+
+        if num_parts is None:
+            return len(part_digests) == 1 and part_digests[0].hex() == entry.md5
+        etag = md5(b"".join(part_digests)).hexdigest()
+        return "%s-%d"%(etag, len(part_digests)) == entry.md5
+
+    """
+    json_obj()
+
+    Returns a json-serializable dict that summarizes the Scrubber's progress
+    """
+    def json_obj(self):
+        with self.checkpoint_lock:
+            cursors = dict(self.cursors)
+        with self.stats_lock:
+            return {
+                'cursors': cursors,
+                'passes': self.passes,
+                'last_pass_finished': self.last_pass_finished,
+                'verify_bytes': self.verify_bytes,
+                'num_scrubbed': self.num_scrubbed,
+                'num_stale': self.num_stale,
+                'num_corrupt': self.num_corrupt,
+                'num_unverified': self.num_unverified,
+                'num_unreachable': self.num_unreachable,
+                'num_delisted': self.num_delisted,
+                'num_errors': self.num_errors,
+                'num_refetched': self.num_refetched,
+                'refetch_queue': self.refetch_queue.qsize(),
+                'recent_problems': list(self.recent_problems),
+            }
+
 
 # This is our regex whitelist, listing URL patterns we will consent to caching
 whitelist = [
@@ -496,6 +887,41 @@ blacklist = [
 greylist = [
 ]
 
+# A list of (regex, replacement) pairs that map mirrors of the same file onto a
+# single canonical URL.  These are applied by canonical_url() after it has
+# already stripped off the scheme and any leading "www.", so they match against
+# things like "ftpmirror.gnu.org/gnu/gmp/gmp-6.1.2.tar.bz2"
+mirror_aliases = [
+    # GNU's mirror redirector serves the same files as the main FTP site
+    (r"^ftpmirror\.gnu\.org/", r"ftp.gnu.org/"),
+
+    # Sourceforge serves every project's files from a few different places
+    (r"^downloads?\.(sourceforge\.net|sf\.net)/project/([^/]+)/", r"sourceforge.net/projects/\2/files/"),
+]
+mirror_aliases = [(re.compile(p), r) for (p, r) in mirror_aliases]
+
+"""
+canonical_url(url)
+
+Returns the canonical form of the given url, which is the same for every url
+we consider to point at the same file: the scheme and any "www." are dropped
+(just as regexify() treats them as optional), the hostname is lowercased, a
+sourceforge "/download" suffix is dropped, and the `mirror_aliases` rules are
+applied.  The result is only ever used as a lookup key, never fetched.
+"""
+@functools.lru_cache(maxsize=4096)
+def canonical_url(url):
+    url = re.sub(r"^((https?)|(ftp))://(www\.)?", "", url)
+    host, sep, path = url.partition("/")
+    url = host.lower() + sep + path
+
+    if "sourceforge" in url and url.endswith("/download"):
+        url = url[:-9]
+
+    for (pattern, replacement) in mirror_aliases:
+        url = pattern.sub(replacement, url)
+    return url
+
 # Take an URL pattern and add all the regex stuff to match an incoming URL
 def regexify(url):
     # Add http://, with optional https and www. in front.  Then, replace all
@@ -506,22 +932,69 @@ def regexify(url):
 
 whitelist = [w for w in map(regexify, whitelist)]
 
-# The list of files that are currently downloading, so we don't download twice
-pending_downloads = []
+# A list of URL patterns (passed through regexify, just like the whitelist) for
+# which cache misses are coalesced: instead of 302'ing every client to the
+# source while we download, we hold them until our download lands and send
+# them all to the cache.  Any request can also opt into this by passing
+# `?coalesce` (or `?coalesce=<seconds>`) along with the URL.
+coalesce_whitelist = [
+    # LLVM tarballs are big and get requested by every CI job at once
+    "releases.llvm.org/[\d.]+",
+]
+coalesce_whitelist = [c for c in map(regexify, coalesce_whitelist)]
+
+# The longest we will hold a client waiting on a coalesced download before
+# giving up and sending them on to the source URL.
+coalesce_timeout = 60
+
+# The files that are currently downloading, so we don't download twice.  This
+# maps each canonical URL to an Event that is set once that download has
+# finished (or failed), so that coalesced requests can wait on it.
+pending_downloads = {}
+pending_downloads_lock = threading.Lock()
+
+# Settings for the background Scrubber: how much of a budget it gets for
+# upstream/S3 requests and for downloads, whether it should also check the
+# bytes we have stored in S3 against their MD5, and how long to wait after
+# finishing one pass through the cache before starting the next.
+scrub_checkpoint_path = "/var/log/cache/scrub.json"
+scrub_requests_per_second = 2
+scrub_bytes_per_second = 10*1024*1024
+scrub_verify_bytes = False
+scrub_pass_interval = 24*60*60
+
+"""
+fetch_in_background(url)
+
+Start a thread downloading the given url into the cache, unless one is already
+running for it.  Returns the `threading.Event` that will be set once the
+download (whichever thread is doing it) has finished, successfully or not.
+"""
+def fetch_in_background(url):
+    global pending_downloads, pending_downloads_lock
+    # Stop double downloads if we get a flood of requests for a single file
+    canonical = canonical_url(url)
+    with pending_downloads_lock:
+        if canonical in pending_downloads:
+            log("[%s] Already downloading, skipping..."%(url))
+            return pending_downloads[canonical]
+        done = threading.Event()
+        pending_downloads[canonical] = done
+
+    name = "download %s"%(url)
+    threading.Thread(target=add_to_cache, args=(url,), name=name, daemon=True).start()
+    return done
 
 """
 add_to_cache(url)
 
-Download the given url and add it to the cache, using `pending_downloads` to
-prevent multiple simultaneous downloads of the same file.
+Download the given url and add it to the cache.  This should only be called
+through `fetch_in_background()`, which registers the url in `pending_downloads`
+so that we never download the same file twice at once; when we're done we
+remove it from there and wake up anyone waiting on it.
 """
 def add_to_cache(url, minsize=1024):
-    global pending_downloads, aws_cache
-    # Stop double downloads if we get a flood of requests for a single file
-    if url in pending_downloads:
-        log("[%s] Already downloading, skipping..."%(url))
-        return
-    pending_downloads += [url]
+    global pending_downloads, pending_downloads_lock, aws_cache
 
     # Download the requested file
     try:
@@ -534,25 +1007,26 @@ def add_to_cache(url, minsize=1024):
             # suffer not the content-type of "text/html" to enter your caches.
             if headers.get("content-type", "") == "text/html":
                 log("[%s] Aborting, we got text/html back!"%(url))
-                pending_downloads.remove(url)
                 return
 
             # If nothing was downloaded, just exit out after cleaning up
             filesize = os.stat(tmp_name).st_size
             if filesize < minsize:
-                log("[%s] Aborting, filesize was <%dk (%d)"%(minsize//1024, url, filesize))
-                pending_downloads.remove(url)
+                log("[%s] Aborting, filesize was <%dk (%d)"%(url, minsize//1024, filesize))
                 return
 
             log("[%s] Successfully finished download: %s (%dB)"%(url, tmp_name, filesize))
             aws_cache.add(url, tmp_name, headers.get("etag", None))
 
-        pending_downloads.remove(url)
         log("[%s] Finished upload"%(url))
     except IOError as e:
         # If we got a 404, clean up
         log("[%s] Aborting, got 404"%(url))
-        pending_downloads.remove(url)
+    finally:
+        with pending_downloads_lock:
+            done = pending_downloads.pop(canonical_url(url), None)
+        if not done is None:
+            done.set()
 
 """
 on_blacklist(url)
@@ -582,6 +1056,52 @@ def on_whitelist(url):
     global whitelist
     return any([re.match(white_url, url) for white_url in whitelist])
 
+"""
+coalesce_wait_time(url)
+
+Returns how many seconds a request for the given URL should wait on an
+in-flight download before falling back to the source URL.  This is zero
+unless the URL is on the coalesce whitelist or the request asked for it with
+`?coalesce`; an explicit `?coalesce=<seconds>` is capped at `coalesce_timeout`.
+"""
+def coalesce_wait_time(url):
+    global coalesce_whitelist, coalesce_timeout
+    wait = request.args.get("coalesce", None)
+    if wait is None:
+        if any([re.match(c_url, url) for c_url in coalesce_whitelist]):
+            return coalesce_timeout
+        return 0
+    try:
+        return max(0, min(float(wait), coalesce_timeout))
+    except ValueError:
+        return coalesce_timeout
+
+"""
+freshen(url, cache_entry)
+
+Start a thread downloading the file requested as `url`, of which `cache_entry`
+is our current (stale) copy, or `None` if we don't have one.  Unless this URL
+coalesces its misses, return immediately redirecting the user temporarily to
+the original URL, until we've actually cached it.  If what went stale was an
+equivalent mirror's copy, we refresh that copy from the URL it was cached from
+rather than storing a second one alongside it.
+"""
+def freshen(url, cache_entry):
+    global aws_cache
+    fetch_url = url if cache_entry is None else cache_entry.url
+    done = fetch_in_background(fetch_url)
+    wait = coalesce_wait_time(fetch_url)
+    if wait > 0:
+        landed = done.wait(wait)
+        mark_phase("coalesce")
+        # If the download landed and actually replaced what we had, send
+        # them on to the fresh copy rather than to the source.
+        new_entry = aws_cache.lookup(url) if landed else None
+        if not new_entry is None and not new_entry is cache_entry:
+            log("[%s] HIT after waiting on download"%(url))
+            return redirect(new_entry.cache_url(), code=301)
+    log("[%s] 302'ing because we need to freshen up"%(url))
+    return redirect(url, code=302)
 
 # Asking for a full URL after <path:url> queries the cache
 @app.route("/<path:url>")
@@ -596,25 +1116,46 @@ def cache(url):
         url = url[:-9]
 
     if on_blacklist(url):
+        mark_phase("classify")
         log("[%s] 404'ing because it's on the blacklist"%(url))
         abort(404)
 
-    # If it's on the greylist, or not on the whitelist, just forward them on
-    # to the source url immediately, because we won't cache those links
-    if on_greylist(url) or not on_whitelist(url):
-        log("[%s] 301'ing to source because it's greylisted or at least not whitelisted"%(url))
+    # If it's on the greylist, just forward them on to the source url
+    # immediately, because we won't cache those links
+    if on_greylist(url):
+        mark_phase("classify")
+        log("[%s] 301'ing to source because it's greylisted"%(url))
         return redirect(url, code=301)
 
+    # If it's not on the whitelist we won't download it, but it may still be a
+    # mirror of a whitelisted file that we've already got cached, in which
+    # case we may as well serve them that.
+    if not on_whitelist(url):
+        cache_entry = aws_cache.lookup(url)
+        mark_phase("classify")
+        if cache_entry is None or on_greylist(cache_entry.url) or not on_whitelist(cache_entry.url):
+            log("[%s] 301'ing to source because it's not whitelisted"%(url))
+            return redirect(url, code=301)
+        aws_cache.hit(url)
+
+        # We only ever refresh the whitelisted URL we originally cached
+        if not cache_entry.check_consistency():
+            mark_phase("consistency")
+            return freshen(url, cache_entry)
+
+        mark_phase("consistency")
+        log("[%s] HIT! (as %s)"%(url, cache_entry.url))
+        return redirect(cache_entry.cache_url(), code=301)
+    mark_phase("classify")
+
     cache_entry = aws_cache.hit(url)
     # If we cache miss or we fail our consistency check, redownload the file
     if cache_entry is None or not cache_entry.check_consistency():
-        # Start a thread downloading, but return immediately redirecting the
-        # user temporarily to the original URL, until we've actually cached it.
-        _thread.start_new_thread(add_to_cache, (url,))
-        log("[%s] 302'ing because we need to freshen up"%(url))
-        return redirect(url, code=302)
+        mark_phase("consistency")
+        return freshen(url, cache_entry)
 
     # Otherwise, forward them on to the cache!
+    mark_phase("consistency")
     log("[%s] HIT!"%(url))
     return redirect(cache_entry.cache_url(), code=301)
 
@@ -716,10 +1257,213 @@ def index():
 
 @app.route("/api/json")
 def json_dump():
-    global aws_cache
-    json_data = json.dumps(aws_cache.json_obj())
+    global aws_cache, scrubber
+    json_obj = aws_cache.json_obj()
+    json_obj['scrubber'] = scrubber.json_obj()
+    json_data = json.dumps(json_obj)
+    return Response(json_data, mimetype="application/json")
+
+
+# Setting CACHE_DEBUG_TOKEN in the environment turns on per-request timing and
+# the /debug/ endpoints below, which must then be sent the token in an
+# `X-Debug-Token` header (not the query string, which ends up in logs).  If
+# it is unset or empty, the endpoints 404 and we do not time anything at all.
+debug_token = os.environ.get("CACHE_DEBUG_TOKEN", None) or None
+
+# We hold on to the timings of this many of the slowest requests we've served
+slow_requests_max = 50
+slow_requests = []
+slow_requests_lock = threading.Lock()
+slow_requests_counter = itertools.count()
+
+# Only one sampling profiler may run at a time
+profile_lock = threading.Lock()
+
+class RequestTimer:
+    """
+    RequestTimer(path)
+
+    Records how long each phase of serving a request took.  `phase(name)`
+    closes out the phase that has been running since the previous call (or
+    since the request started), so phases are marked at the point they end.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.start = time.time()
+        self.last = self.start
+        self.phases = []
+
+    def phase(self, name):
+        now = time.time()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def total(self):
+        return self.last - self.start
+
+    # How long we spent actually working on this request, not counting time
+    # spent parked waiting on a coalesced download, which would otherwise
+    # crowd everything else out of the slowest requests.
+    def busy_time(self):
+        return self.total() - sum(t for n, t in self.phases if n == "coalesce")
+
+    def json_obj(self):
+        return {
+            'path': self.path,
+            'start': self.start,
+            'total': self.total(),
+            'busy': self.busy_time(),
+            'phases': [{'name': n, 'time': t} for n, t in self.phases],
+        }
+
+"""
+mark_phase(name)
+
+Mark the end of the named phase of the current request, if we're timing it.
+"""
+def mark_phase(name):
+    timer = g.get('request_timer', None)
+    if not timer is None:
+        timer.phase(name)
+
+@app.before_request
+def start_request_timer():
+    global debug_token
+    if debug_token is None or request.path.startswith("/debug/"):
+        return
+    g.request_timer = RequestTimer(request.path)
+
+@app.after_request
+def finish_request_timer(response):
+    global slow_requests, slow_requests_lock, slow_requests_max
+    timer = g.get('request_timer', None)
+    if timer is None:
+        return response
+    timer.phase("respond")
+
+    # Keep a min-heap of the slowest requests, so the fastest of them is always
+    # the one we evict when a slower request comes along
+    item = (timer.busy_time(), next(slow_requests_counter), timer)
+    with slow_requests_lock:
+        if len(slow_requests) < slow_requests_max:
+            heapq.heappush(slow_requests, item)
+        elif item[0] > slow_requests[0][0]:
+            heapq.heapreplace(slow_requests, item)
+    return response
+
+"""
+check_debug_token()
+
+Abort with a 404 unless debugging is enabled and the request carries the right
+token, so that the debug endpoints are indistinguishable from uncached files.
+"""
+def check_debug_token():
+    global debug_token
+    token = request.headers.get("X-Debug-Token", "")
+    if debug_token is None or not hmac.compare_digest(token.encode(), debug_token.encode()):
+        abort(404)
+
+"""
+sample_stacks(seconds, interval)
+
+Every `interval` seconds for `seconds` seconds, grab the stack of every thread
+other than our own, and count how many times we saw each one.  Returns a
+`Counter` keyed by stacks in the "collapsed" format understood by
+flamegraph.pl, e.g. `thread name;cache.py:cache;cache.py:check_consistency`.
+"""
+def sample_stacks(seconds, interval=0.01):
+    stacks = collections.Counter()
+    me = threading.get_ident()
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while not frame is None:
+                code = frame.f_code
+                stack.append("%s:%s"%(basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            stack.append(names.get(ident, "thread %d"%(ident)))
+            stack = [s.replace(";", ":") for s in reversed(stack)]
+            stacks[";".join(stack)] += 1
+        time.sleep(interval)
+    return stacks
+
+"""
+flamegraph_tree(stacks)
+
+Fold collapsed stacks into the nested `{name, value, children}` tree that
+d3-flame-graph and friends consume.
+"""
+def flamegraph_tree(stacks):
+    root = {'name': 'all', 'value': 0, 'children': {}}
+    for stack, count in stacks.items():
+        node = root
+        node['value'] += count
+        for frame in stack.split(";"):
+            if not frame in node['children']:
+                node['children'][frame] = {'name': frame, 'value': 0, 'children': {}}
+            node = node['children'][frame]
+            node['value'] += count
+
+    def listify(node):
+        node['children'] = [listify(c) for c in node['children'].values()]
+        return node
+    return listify(root)
+
+# Sample every thread's stack for `?seconds=N` (at most a minute) and return
+# collapsed stacks, or a flamegraph tree if asked for `?format=json`
+@app.route("/debug/profile")
+def debug_profile():
+    global profile_lock
+    check_debug_token()
+    try:
+        seconds = max(0.1, min(float(request.args.get("seconds", 10)), 60))
+    except ValueError:
+        abort(400)
+    if not profile_lock.acquire(blocking=False):
+        abort(409)
+    try:
+        stacks = sample_stacks(seconds)
+    finally:
+        profile_lock.release()
+
+    if request.args.get("format", "collapsed") == "json":
+        json_data = json.dumps(flamegraph_tree(stacks))
+        return Response(json_data, mimetype="application/json")
+    lines = ["%s %d"%(stack, count) for stack, count in sorted(stacks.items())]
+    return Response("\n".join(lines) + "\n", mimetype="text/plain")
+
+# The phase timings of the slowest requests we've served (not counting time
+# spent waiting on coalesced downloads), slowest first
+@app.route("/debug/slow")
+def debug_slow():
+    global slow_requests, slow_requests_lock
+    check_debug_token()
+    with slow_requests_lock:
+        timers = [t for _, _, t in sorted(slow_requests, reverse=True)]
+    json_data = json.dumps([t.json_obj() for t in timers])
     return Response(json_data, mimetype="application/json")
 
+# What every thread (including background downloads) is up to right now
+@app.route("/debug/threads")
+def debug_threads():
+    check_debug_token()
+    threads = {t.ident: t for t in threading.enumerate()}
+    dump = ""
+    for ident, frame in sys._current_frames().items():
+        t = threads.get(ident, None)
+        if t is None:
+            dump += "Thread %d:\n"%(ident)
+        else:
+            daemon = " (daemon)" if t.daemon else ""
+            dump += "Thread %d \"%s\"%s:\n"%(ident, t.name, daemon)
+        dump += "".join(traceback.format_stack(frame))
+        dump += "\n"
+    return Response(dump, mimetype="text/plain")
+
 if __name__ == "__main__":
     init_logging(app)
 
@@ -729,4 +1473,12 @@ if __name__ == "__main__":
     # This is a good debugging check
     #aws_cache.check_cache_consistency()
 
+    # Slowly keep checking over everything we've cached in the background
+    scrubber = Scrubber(aws_cache, scrub_checkpoint_path,
+                        requests_per_second=scrub_requests_per_second,
+                        bytes_per_second=scrub_bytes_per_second,
+                        verify_bytes=scrub_verify_bytes,
+                        pass_interval=scrub_pass_interval)
+    scrubber.start()
+
     app.run(host="0.0.0.0",threaded=True)